@@ -3,22 +3,225 @@ https://cogs-staging-drafter.publishmydata.com/
 """
 
 # %%
+import asyncio
+import hashlib
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from urllib.parse import urljoin
 from uuid import UUID
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util import Retry
+
+try:
+    import httpx
+except ImportError:  # Only needed by AsyncPublishMyData.
+    httpx = None
+
+try:
+    import h2
+except ImportError:  # Enables HTTP/2 in AsyncPublishMyData when installed.
+    h2 = None
+
+try:
+    import orjson
+except ImportError:  # Optional faster JSON decoding.
+    orjson = None
 
 AUTH0_URL = "https://swirrl-staging.eu.auth0.com/oauth/token"
 DEFAULT_BASE_URL = "https://cogs-staging-drafter.publishmydata.com/v1/"
 
+# Connections kept open per host; bounds useful upload concurrency.
+POOL_MAXSIZE = 20
+
+# Retry jitter is only supported from urllib3 2.0; older versions retry with
+# plain exponential backoff.
+_RETRY_JITTER = (
+    {"backoff_jitter": 0.5}
+    if "backoff_jitter" in inspect.signature(Retry).parameters
+    else {}
+)
+
+# Seconds before a token's stated expiry at which it is refreshed.
+TOKEN_REFRESH_MARGIN = 60
+
+# Times a rate-limited (HTTP 429) token request is retried.
+TOKEN_RETRIES = 3
+
+# Access tokens shared between clients using the same credentials, keyed by a
+# hash of those credentials. Holds (access_token, monotonic expiry) tuples.
+# Each key has its own lock so one slow or rate-limited set of credentials
+# does not hold up the others; _TOKEN_LOCK only guards creating those locks.
+_TOKEN_CACHE = {}
+_TOKEN_LOCKS = {}
+_TOKEN_LOCK = threading.Lock()
+
+# RDF serialisations accepted by append_data.
+_EXTENSION_MAP = {
+    ".trig": "application/trig",
+    ".ttl": "text/turtle",
+    ".nq": "application/n-quads",
+    ".trix": "application/trix",
+    ".nt": "application/n-triples",
+    ".rdf": "application/rdf+xml"
+}
+_VALID_EXTS = frozenset(_EXTENSION_MAP) | {None}
+_VALID_CTS = frozenset(_EXTENSION_MAP.values()) | {None}
+_TRIPLE_CTS = frozenset({
+    "text/turtle",
+    "application/trix",
+    "application/n-triples",
+    "application/rdf+xml"
+})
+_VALID_ENCODING = frozenset({"gzip", "x-gzip", None})
+
+# Argument values accepted by get_draftsets and Draftset.submit_to.
+_VALID_INCLUDE = frozenset({"owned", "claimable", "all"})
+_VALID_ROLES = frozenset({"editor", "publisher", "manager", None})
+
+# Draftset types the API returns.
+_VALID_TYPES = frozenset({"Endpoint", "Draftset"})
+
+# Draftset JSON keys from the API and the Draftset attributes they populate.
+_JSON_TO_ATTR = {
+    "id": "id",
+    "type": "type",
+    "created-at": "created_at",
+    "updated-at": "updated_at",
+    "changes": "changes",
+    "display-name": "display_name",
+    "current-owner": "current_owner",
+    "submitted-by": "submitted_by",
+    "claim-role": "claim_role",
+    "claim-user": "claim_user",
+    "description": "description"
+}
+
+
+def _parse_json(response):
+    """
+    Decodes a JSON response body, using orjson straight from the raw bytes
+    when it is installed.
+    """
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+def _has_json_body(response):
+    """Returns whether the response carries a non-empty JSON body."""
+    return bool(response.content) and "json" in response.headers.get(
+        "content-type", ""
+    )
+
+
+def _check(response, *expected):
+    """
+    Raises a RequestException carrying the response body unless the response
+    has one of the expected status codes.
+    """
+    if response.status_code not in expected:
+        raise RequestException(response.text)
+
+
+def _data_content_type(extension, content_type, graph, content_encoding):
+    """
+    Validates the arguments describing RDF data to be appended to a draftset
+    and returns the content type to upload it as.
+    """
+    if not (extension or content_type):
+        raise ValueError("Specify an extension or content_type.")
+    if extension not in _VALID_EXTS:
+        raise ValueError(f"Invalid extension: {extension!r}")
+    if content_type not in _VALID_CTS:
+        raise ValueError(f"Invalid content_type: {content_type!r}")
+
+    if extension:
+        content_type = _EXTENSION_MAP[extension]
+
+    # Triple serialisations carry no graph, so one must be supplied.
+    if content_type in _TRIPLE_CTS and not graph:
+        raise ValueError(f"A graph is required for {content_type} data.")
+
+    if content_encoding not in _VALID_ENCODING:
+        raise ValueError(f"Invalid content_encoding: {content_encoding!r}")
+
+    return content_type
+
+
+def _request_token(payload):
+    """
+    Requests an access token from Auth0, waiting out any rate limit it
+    signals via Retry-After before trying again.
+    """
+    for attempt in range(TOKEN_RETRIES + 1):
+        # Not sent through a client's session, whose auth hook would try to
+        # refresh the token being fetched.
+        response = requests.post(
+            AUTH0_URL,
+            headers={
+                "content-type": "application/json"
+            },
+            json=payload
+        )
+        if response.status_code != 429 or attempt == TOKEN_RETRIES:
+            return response
+
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(int(retry_after) if retry_after.isdigit() else 1)
+
 
-@dataclass
+@dataclass(slots=True)
 class PublishMyData():
     client_id: str
     client_secret: str
     base_url: str = DEFAULT_BASE_URL
+    # Set up in __post_init__; declared so they have slots.
+    access_token: str = field(init=False, repr=False, compare=False)
+    _session: requests.Session = field(init=False, repr=False, compare=False)
+    _token_expiry: float = field(init=False, repr=False, compare=False)
+    _token_args: tuple = field(init=False, repr=False, compare=False)
+    _draftsets_url: str = field(init=False, repr=False, compare=False)
+    _draftset_url_tpl: str = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
+        # urljoin replaces the last path segment unless it ends with a slash.
+        base = self.base_url.rstrip("/") + "/"
+        self._draftsets_url = urljoin(base, "draftsets")
+        self._draftset_url_tpl = urljoin(base, "draftset/{}")
+
+        # A single session lets every call reuse pooled TCP/TLS connections.
+        self._session = requests.Session()
+        # Transient failures are retried with jittered exponential backoff.
+        # Status retries only apply to idempotent methods; connection errors
+        # are retried for every method, as the request never reached the
+        # server.
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD", "PUT", "DELETE"]),
+            respect_retry_after_header=True,
+            # Hand back the last response so callers report the server error.
+            raise_on_status=False,
+            **_RETRY_JITTER
+        )
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=retry
+            )
+        )
+        self._session.headers.update({
+            "Accept": "application/json"
+        })
+        self._session.auth = self._authenticate
         self.get_token(self.client_id, self.client_secret)
 
     def get_token(
@@ -26,26 +229,56 @@ class PublishMyData():
         client_id,
         client_secret,
         audience="https://pmd",
-        grant_type="client_credentials"
+        grant_type="client_credentials",
+        force=False
     ):
-        """Authenticate using client id and secret."""
-        response = requests.post(
-            AUTH0_URL,
-            headers={
-                "content-type": "application/json"
-            },
-            json={
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "audience": audience,
-                "grant_type": grant_type
-            }
-        )
+        """
+        Authenticate using client id and secret. Tokens are cached per set of
+        credentials and only requested again shortly before they expire, or
+        when force is set (e.g. after the cached token has been revoked).
+        """
+        token_args = (client_id, client_secret, audience, grant_type)
+        key = hashlib.sha256("\0".join(token_args).encode("utf-8")).hexdigest()
+
+        with _TOKEN_LOCK:
+            lock = _TOKEN_LOCKS.setdefault(key, threading.Lock())
+
+        # Holding the lock while fetching stops concurrent callers from all
+        # requesting a new token for these credentials at once.
+        with lock:
+            cached = _TOKEN_CACHE.get(key)
+            if force or cached is None or time.monotonic() >= cached[1]:
+                response = _request_token({
+                    "client_id": client_id,
+                    "client_secret": client_secret,
+                    "audience": audience,
+                    "grant_type": grant_type
+                })
+
+                _check(response, 200)
+                data = _parse_json(response)
+                cached = (
+                    data["access_token"],
+                    time.monotonic() + data["expires_in"]
+                    - TOKEN_REFRESH_MARGIN
+                )
+                _TOKEN_CACHE[key] = cached
+
+        self.access_token, self._token_expiry = cached
+        self._token_args = token_args
+
+    def _auth_header(self):
+        """
+        Returns the Authorization header value, refreshing the token first if
+        it is about to expire.
+        """
+        if time.monotonic() >= self._token_expiry:
+            self.get_token(*self._token_args)
+        return f"Bearer {self.access_token}"
 
-        if response.status_code == 200:
-            self.access_token = response.json()["access_token"]
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+    def _authenticate(self, request):
+        request.headers["Authorization"] = self._auth_header()
+        return request
 
     def get_draftsets(self, include="all", union_with_live=False):
         """
@@ -54,78 +287,41 @@ class PublishMyData():
         those not owned which can be claimed by the current user. By default all
         owned and claimable draftsets are returned.
         """
-        assert include in ("owned", "claimable", "all")
-        assert isinstance(union_with_live, bool)
+        if include not in _VALID_INCLUDE:
+            raise ValueError(f"Invalid include: {include!r}")
+        if not isinstance(union_with_live, bool):
+            raise TypeError("union_with_live must be a bool.")
 
-        response = requests.get(
-            "https://cogs-staging-drafter.publishmydata.com/v1/draftsets",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.access_token}"
-            },
-            data={
-                "incude": include,
-                "union-with-live": union_with_live
+        response = self._session.get(
+            self._draftsets_url,
+            params={
+                "include": include,
+                "union-with-live": str(union_with_live).lower()
             }
         )
 
-        if response.status_code == 200:
-            data = response.json()
-            draftsets = [
-                Draftset(
-                    _requester=self,
-                    id=d["id"],
-                    type=d["type"],
-                    created_at=d["created-at"],
-                    updated_at=d["updated-at"],
-                    changes=d["changes"],
-                    display_name=d.get("display-name", None),
-                    current_owner=d.get("current-owner", None),
-                    submitted_by=d.get("submitted-by", None),
-                    claim_role=d.get("claim-role", None),
-                    claim_user=d.get("claim-user", None),
-                    description=d.get("description", None)
-                ) for d in data
-            ]
-            return draftsets
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 200)
+        data = _parse_json(response)
+        draftsets = [Draftset.from_api(self, d) for d in data]
+        return draftsets
 
     def get_draftset(self, id: UUID, union_with_live=False):
         """Returns metadata about the draftset."""
 
-        assert isinstance(union_with_live, bool)
+        if not isinstance(union_with_live, bool):
+            raise TypeError("union_with_live must be a bool.")
 
-        response = requests.get(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{id}",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.access_token}"
-            },
-            data={
-                "union-with-live": union_with_live
+        response = self._session.get(
+            self._draftset_url_tpl.format(id),
+            params={
+                "union-with-live": str(union_with_live).lower()
             }
         )
 
-        if response.status_code == 200:
-            data = response.json()
-            draftset = Draftset(
-                _requester=self,
-                id=data["id"],
-                type=data["type"],
-                created_at=data["created-at"],
-                updated_at=data["updated-at"],
-                changes=data["changes"],
-                display_name=data.get("display-name", None),
-                current_owner=data.get("current-owner", None),
-                submitted_by=data.get("submitted-by", None),
-                claim_role=data.get("claim-role", None),
-                claim_user=data.get("claim-user", None),
-                description=data.get("description", None)
-            )
-            return draftset
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 200)
+        data = _parse_json(response)
+        draftset = Draftset.from_api(self, data)
+        return draftset
 
     def create_draftset(
         self,
@@ -137,29 +333,27 @@ class PublishMyData():
         Creates a new draftset in the database. Optionally accepts query string
         parameters for a name and a description.
         """
-        response = requests.post(
-            "https://cogs-staging-drafter.publishmydata.com/v1/draftsets",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.access_token}"
-            },
-            data={
+        response = self._session.post(
+            self._draftsets_url,
+            params={
                 "display-name": display_name,
                 "description": description,
-                "union-with-live": union_with_live
+                "union-with-live": str(union_with_live).lower()
             },
             # Create draftset returns a HTTP 303 which we do not want to
             # redirect to. Redirecting produces a HTTP 401 response.
             allow_redirects=False
         )
 
-        if response.status_code == 303:
-            draftset_id = response.headers["location"].rsplit("/")[-1]
-            return self.get_draftset(id=draftset_id)
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 303)
+        # Some deployments include the new draftset in the response, which
+        # saves fetching it.
+        if _has_json_body(response):
+            return Draftset.from_api(self, _parse_json(response))
+        draftset_id = response.headers["location"].rsplit("/")[-1]
+        return self.get_draftset(id=draftset_id)
 
-@dataclass
+@dataclass(slots=True)
 class Draftset():
     _requester: PublishMyData = field(repr=False)
     id: UUID
@@ -173,26 +367,31 @@ class Draftset():
     claim_role: str = None
     claim_user: str = None
     description: str = None
+    _url: str = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
-        assert self.type in ("Endpoint", "Draftset")
+        if self.type not in _VALID_TYPES:
+            raise ValueError(f"Invalid draftset type: {self.type!r}")
+        self._url = self._requester._draftset_url_tpl.format(self.id)
+
+    @classmethod
+    def from_api(cls, requester, data):
+        """Builds a Draftset from its JSON representation in the API."""
+        return cls(
+            _requester=requester,
+            **{attr: data.get(key) for key, attr in _JSON_TO_ATTR.items()}
+        )
 
     def delete(self, metadata=None):
         """Deletes the draftset and its contents."""
-        response = requests.delete(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{self.id}",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self._requester.access_token}"
-            },
-            data={
+        response = self._requester._session.delete(
+            self._url,
+            params={
                 "metadata": metadata
             }
         )
-        if response.status_code == 202:
-            return True
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 202)
+        return True
 
     def claim(self):
         """
@@ -205,17 +404,15 @@ class Draftset():
         the rank of the pools role is less than or equal to the user’s role’s
         rank.
         """
-        response = requests.post(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{self.id}/claim",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self._requester.access_token}"
-            }
+        response = self._requester._session.post(
+            f"{self._url}/claim"
         )
-        if response.status_code == 200:
-            return self._requester.get_draftset(id=self.id)
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 200)
+        # The response body is normally the updated draftset, which saves
+        # fetching it.
+        if _has_json_body(response):
+            return Draftset.from_api(self._requester, _parse_json(response))
+        return self._requester.get_draftset(id=self.id)
 
     def submit_to(self, role=None, user=None):
         """
@@ -227,26 +424,27 @@ class Draftset():
         submitted to can then lay claim to it.
         """
 
-        assert role in ("editor", "publisher", "manager", None)
-        assert isinstance(user, str) or (user is None)
-        assert bool(role) ^ bool(user) # Exclusive OR - only specify one.
+        if role not in _VALID_ROLES:
+            raise ValueError(f"Invalid role: {role!r}")
+        if not (isinstance(user, str) or user is None):
+            raise TypeError("user must be a str or None.")
+        if not bool(role) ^ bool(user): # Exclusive OR - only specify one.
+            raise ValueError("Specify exactly one of role or user.")
 
-        response = requests.post(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{self.id}/submit-to",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self._requester.access_token}"
-            },
+        response = self._requester._session.post(
+            f"{self._url}/submit-to",
             json={
                 "role": role,
                 "user": user
             }
         )
 
-        if response.status_code == 200:
-            return self._requester.get_draftset(id=self.id)
-        else:
-            raise RequestException(str(response.content, "utf-8"))
+        _check(response, 200)
+        # The response body is normally the updated draftset, which saves
+        # fetching it.
+        if _has_json_body(response):
+            return Draftset.from_api(self._requester, _parse_json(response))
+        return self._requester.get_draftset(id=self.id)
 
 
     def publish(self, metadata=None):
@@ -255,16 +453,14 @@ class Draftset():
         site. If a job is successfully scheduled then an AsyncJob object will be
         returned.
         """
-        requests.post(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{self.id}/publish",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self._requester.access_token}"
-            },
+        response = self._requester._session.post(
+            f"{self._url}/publish",
             data={
                 "metadata": metadata
             }
         )
+        # Publishing runs as an asynchronous job on the server.
+        _check(response, 202)
 
     def append_data(
         self,
@@ -290,56 +486,143 @@ class Draftset():
         Content-Encoding header should be set to gzip on the request.
         """
 
-        extension_map = {
-            ".trig": "application/trig",
-            ".ttl": "text/turtle",
-            ".nq": "application/n-quads",
-            ".trix": "application/trix",
-            ".nt": "application/n-triples",
-            ".rdf": "application/rdf+xml"
-        }
+        content_type = _data_content_type(
+            extension, content_type, graph, content_encoding
+        )
+        self._put_data(filepath, content_type, graph, metadata, content_encoding)
 
-        assert(extension or content_type)
+    def append_many(
+        self,
+        filepaths,
+        extension=None,
+        content_type=None,
+        graph=None,
+        metadata=None,
+        content_encoding=None,
+        max_concurrency=4
+    ):
+        """
+        Appends each of the supplied files to this Draftset, uploading up to
+        max_concurrency of them at once over the client's shared connection
+        pool. The remaining arguments apply to every file, as in append_data.
 
-        assert extension in (
-            ".trig", ".ttl", ".nq", ".trix", ".nt", ".rdf", None
-        )
+        Returns a list with one entry per file, in order: None if the upload
+        succeeded, otherwise the exception it raised.
+        """
+        if not 1 <= max_concurrency <= POOL_MAXSIZE:
+            raise ValueError(
+                f"max_concurrency must be between 1 and {POOL_MAXSIZE}."
+            )
 
-        assert content_type in (
-            "application/trig",
-            "text/turtle",
-            "application/n-quads",
-            "application/trix",
-            "application/n-triples",
-            "application/rdf+xml",
-            None
+        # Invalid arguments would fail every upload, so raise them once here.
+        content_type = _data_content_type(
+            extension, content_type, graph, content_encoding
         )
 
-        if extension:
-            content_type = extension_map[extension]
+        def append(filepath):
+            try:
+                self._put_data(
+                    filepath, content_type, graph, metadata, content_encoding
+                )
+            except Exception as e:
+                return e
 
-        if content_type in (
-            "text/turtle", 
-            "application/trix", 
-            "application/n-triples",
-            "application/rdf+xml"
-        ):
-            assert graph
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(append, filepaths))
 
-        assert content_encoding in ("gzip", "x-gzip", None)
+    def _put_data(
+        self,
+        filepath,
+        content_type,
+        graph,
+        metadata,
+        content_encoding
+    ):
+        # Passing the open file streams it from disk in chunks rather than
+        # reading it all into memory. Its size is known, so the upload is sent
+        # with a Content-Length rather than chunked. Already-compressed files
+        # are sent as they are.
+        with open(filepath, "rb") as rdf:
+            response = self._requester._session.put(
+                f"{self._url}/data",
+                headers={
+                    "Content-Type": content_type,
+                    "Content-Encoding": content_encoding
+                },
+                params={
+                    "graph": graph,
+                    "metadata": metadata
+                },
+                data=rdf
+            )
+        # The data is imported by an asynchronous job on the server.
+        _check(response, 202)
+
+@dataclass(slots=True)
+class AsyncPublishMyData(PublishMyData):
+    """
+    A PublishMyData client which can also fetch many draftsets concurrently,
+    multiplexing the requests over a single HTTP/2 connection. Requires the
+    optional httpx dependency (`pip install httpx[http2]`); without h2 the
+    requests share HTTP/1.1 connections instead.
 
-        rdf = open(filepath).read()
+    Draftsets returned by the async methods use the synchronous session for
+    their own operations.
+    """
 
-        requests.put(
-            f"https://cogs-staging-drafter.publishmydata.com/v1/draftset/{self.id}/data",
+    def __post_init__(self):
+        if httpx is None:
+            raise ImportError("AsyncPublishMyData requires httpx.")
+        # Zero-argument super() does not work in slotted dataclasses.
+        PublishMyData.__post_init__(self)
+
+    def _async_client(self):
+        # The client is bound to the event loop it is used in, so a fresh one
+        # is created per batch rather than stored on the instance.
+        return httpx.AsyncClient(
+            http2=h2 is not None,
+            limits=httpx.Limits(
+                max_connections=20,
+                max_keepalive_connections=20
+            ),
             headers={
-                "Content-Type": content_type,
-                "Content-Encoding": content_encoding,
-                "Authorization": f"Bearer {self._requester.access_token}"
-            },
+                "Accept": "application/json",
+                "Authorization": self._auth_header()
+            }
+        )
+
+    async def _get_draftset_async(self, client, id: UUID, union_with_live):
+        response = await client.get(
+            self._draftset_url_tpl.format(id),
             params={
-                "graph": graph,
-                "metadata": metadata
-            },
-            data=rdf
+                "union-with-live": str(union_with_live).lower()
+            }
+        )
+
+        _check(response, 200)
+        data = _parse_json(response)
+        draftset = Draftset.from_api(self, data)
+        return draftset
+
+    async def get_draftsets_detailed(self, ids, union_with_live=False):
+        """
+        Returns metadata about each of the given draftsets, fetching them
+        concurrently. Results are in the same order as the ids.
+        """
+        if not isinstance(union_with_live, bool):
+            raise TypeError("union_with_live must be a bool.")
+
+        async with self._async_client() as client:
+            return await asyncio.gather(*(
+                self._get_draftset_async(client, id, union_with_live)
+                for id in ids
+            ))
+
+    def get_draftsets_detailed_sync(self, ids, union_with_live=False):
+        """
+        Blocking version of get_draftsets_detailed for use outside of an event
+        loop.
+        """
+        return asyncio.run(
+            self.get_draftsets_detailed(ids, union_with_live=union_with_live)
         )